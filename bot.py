@@ -5,20 +5,36 @@ Telegram bot to download magnet links via Transmission RPC API
 
 import os
 import re
+import hmac
+import hashlib
+import string
 import json
 import time
 import logging
+import logging.handlers
+import queue
+import atexit
+import signal
 import threading
-from typing import Dict, List, Optional
+import types
+import pathlib
+from collections.abc import Mapping
 from dataclasses import dataclass
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from urllib.parse import urlparse
 import asyncio
 
+import orjson
 import requests as http_requests
+import aiohttp
 from bs4 import BeautifulSoup
 import transmission_rpc
-from transmission_rpc.error import TransmissionError
+from transmission_rpc.error import (
+    TransmissionAuthError,
+    TransmissionConnectError,
+    TransmissionError,
+    TransmissionTimeoutError,
+)
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.error import BadRequest
 from telegram.ext import (
@@ -35,13 +51,30 @@ from aiohttp import web
 # Load environment variables
 load_dotenv()
 
-# Configure logging
+# Configure logging. Records don't need thread/process info; skip collecting it.
+logging.logThreads = False
+logging.logProcesses = False
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+
+def _setup_queue_logging() -> None:
+    """Hand log records to a background thread: handlers just enqueue, the
+    listener thread formats and writes to stderr, so a slow or contended
+    stream never stalls the event loop."""
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    # Flush what's still queued on exit.
+    atexit.register(listener.stop)
+
+
 # Configuration from environment variables
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TRANSMISSION_URL = os.getenv('TRANSMISSION_URL', 'http://localhost:9091')
@@ -63,9 +96,11 @@ AI_LLM_ENABLED = bool(AI_LLM_API_BASE_URL and AI_LLM_API_KEY)
 WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', 'false').lower() == 'true'
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'https://torrent-bot.svc.fred.org.ru/update')
 WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+_WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET_TOKEN.encode() if WEBHOOK_SECRET_TOKEN else b''
 
-# Default download directories if not available from Transmission
-DEFAULT_DOWNLOAD_DIRS = {
+# Default download directories if not available from Transmission. Read-only,
+# so it is handed out as-is and identity checks against it stay valid.
+DEFAULT_DOWNLOAD_DIRS = types.MappingProxyType({
     '🎬 Movies': '/downloads/complete/movies',
     '📺 TV Shows': '/downloads/complete/tvseries',
     '📚 Books': '/downloads/complete/books',
@@ -74,7 +109,13 @@ DEFAULT_DOWNLOAD_DIRS = {
     '💻 Soft': '/downloads/complete/soft',
     '🎵 Music': '/downloads/complete/music',
     '📖 Courses': '/downloads/complete/courses'
-}
+})
+
+# Stable order for the folder keyboard: buttons carry "d:<index>" into this
+# tuple instead of the full path (callback_data is capped at 64 bytes).
+_DIRS_ITEMS = tuple(DEFAULT_DOWNLOAD_DIRS.items())
+# Reverse lookup for rt_setdir:<path> callbacks.
+_DIRS_LABELS = {path: label for label, path in _DIRS_ITEMS}
 
 # LLM content category -> (button label, download dir). When a search went
 # through the LLM with a confident type, the folder is picked automatically
@@ -90,111 +131,139 @@ CATEGORY_TO_DIR = {
     'other': ('📁 Other', '/downloads/complete/other'),
 }
 
-# Magnet link regex pattern
-MAGNET_PATTERN = re.compile(r'magnet:\?[^\s]+')
+# Magnet link regex pattern. Deliberately not re.ASCII: ASCII \S also matches
+# NBSP and other Unicode spaces, so a link would run on past them.
+MAGNET_PATTERN = re.compile(r'magnet:\?\S+')
+_MAGNET_FIND = MAGNET_PATTERN.findall
 
 TORRENT_JOBS_KEY = 'tracked_torrent_jobs'
 TORRENT_POLL_INTERVAL = 30  # seconds
+# torrent-get fields the completion monitor reads (progress/percent_done,
+# status, download_dir). Everything else — files, peers, trackers — would be
+# fetched and parsed every poll for nothing.
+TORRENT_MONITOR_FIELDS = ['percentDone', 'status', 'downloadDir']
+# The only update types with handlers; Telegram filters the rest server-side.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+POLLING_TIMEOUT = 50  # seconds; getUpdates long-poll timeout
 HEALTHZ_PATH = '/healthz'  # Health check endpoint path
+_HEALTH_BODY = b'OK'  # pre-encoded; probes hit /healthz every few seconds
+
+# Status page template, read once at import; {{NAME}} placeholders are
+# rewritten to string.Template's ${NAME} so each render is a single pass.
+# WEBHOOK_MODE never changes at runtime, so it is filled in here already.
+_STATUS_TEMPLATE_PATH = pathlib.Path(__file__).with_name('status_page.html')
+_STATUS_TEMPLATE = string.Template(
+    string.Template(
+        _STATUS_TEMPLATE_PATH.read_text(encoding='utf-8')
+        .replace('{{', '${').replace('}}', '}')
+    ).safe_substitute(WEBHOOK_MODE='Enabled' if WEBHOOK_MODE else 'Disabled (Polling)'))
+
+_TRANSMISSION_DETAILS_TEMPLATE = string.Template("""
+        <div class="status-row">
+            <div class="status-label">Version:</div>
+            <div class="status-value">${VERSION}</div>
+        </div>
+        <div class="status-row">
+            <div class="status-label">Download Directory:</div>
+            <div class="status-value">${DOWNLOAD_DIR}</div>
+        </div>
+        <div class="status-row">
+            <div class="status-label">Active Torrents:</div>
+            <div class="status-value">${ACTIVE_TORRENTS}</div>
+        </div>""")
+
+_ERROR_SECTION_TEMPLATE = string.Template("""
+        <div class="error-box">
+            <strong>Connection Error:</strong><br>
+            ${ERROR_MESSAGE}
+        </div>""")
 
 # Global in-memory store for torrent monitoring tasks
-_torrent_monitor_tasks: Dict[int, asyncio.Task] = {}
+_torrent_monitor_tasks: dict[int, asyncio.Task] = {}
+
+# Magnet links awaiting a folder pick, per user: user_id -> (magnets,
+# monotonic time stored). Abandoned entries expire after _PENDING_TTL.
+_PENDING: dict[int, tuple[list[str], float]] = {}
+_PENDING_TTL = 600  # seconds
+_PENDING_MAX = 1024
 
 
 async def healthz_handler(request):
     """Health check endpoint handler"""
-    return web.Response(text='OK', status=200)
+    return web.Response(body=_HEALTH_BODY, status=200, content_type='text/plain')
+
+
+# Last rendered status page: (snapshot it was rendered from, html, etag).
+# The snapshot is cached by identity, so an unchanged one reuses the page.
+_status_page_cache = (None, '', '')
 
 
 async def status_handler(request):
     """Status page endpoint handler"""
+    global _status_page_cache
     # Get Transmission status
-    transmission_status = get_transmission_status()
+    transmission_status = await get_transmission_status()
     
-    # Generate HTML status page
-    html_content = generate_status_page(transmission_status)
+    # Generate HTML status page (only when the snapshot was refreshed)
+    cached_status, html_content, etag = _status_page_cache
+    if transmission_status is not cached_status:
+        html_content = generate_status_page(transmission_status)
+        digest = hashlib.blake2b(html_content.encode('utf-8'), digest_size=8).hexdigest()
+        # Weak: the same page may go out gzip- or deflate-encoded.
+        etag = f'W/"{digest}"'
+        _status_page_cache = (transmission_status, html_content, etag)
     
-    return web.Response(text=html_content, content_type='text/html', status=200)
+    # max-age matches the status snapshot TTL; the HTML compresses well.
+    headers = {'Cache-Control': f'max-age={int(_STATUS_TTL)}', 'ETag': etag}
+    if_none_match = request.headers.get('If-None-Match', '')
+    if etag in (tag.strip() for tag in if_none_match.split(',')):
+        return web.Response(status=304, headers=headers)
+    response = web.Response(text=html_content, content_type='text/html', status=200,
+                            headers=headers)
+    response.enable_compression()
+    return response
+
+
+# Status snapshot TTL: bursts of /status probes and /status commands collapse
+# into one session-get + torrent-get pair per window.
+_STATUS_TTL = 2.0  # seconds
 
 
-def get_transmission_status():
+async def get_transmission_status():
     """Get Transmission connection status and details"""
-    status = {
-        'connected': False,
-        'error': None,
-        'version': None,
-        'download_dir': None,
-        'active_torrents': 0
-    }
-    
-    try:
-        if transmission_client.client:
-            session = transmission_client.client.get_session()
-            torrents = transmission_client.client.get_torrents()
-            status['connected'] = True
-            status['version'] = session.version
-            status['download_dir'] = session.download_dir
-            status['active_torrents'] = len(torrents)
-        else:
-            status['error'] = 'Transmission client not initialized'
-    except Exception as e:
-        status['error'] = str(e)
-    
-    return status
+    return await transmission_client.get_status_snapshot()
 
 
 def generate_status_page(transmission_status):
     """Generate HTML status page"""
-    # Load HTML template
-    template_path = os.path.join(os.path.dirname(__file__), 'status_page.html')
-    with open(template_path, 'r', encoding='utf-8') as f:
-        html = f.read()
-    
     # Prepare values for substitution
     app_status = "✅ Running" if transmission_status['connected'] else "⚠️ Running (Transmission not connected)"
     transmission_icon = "✅" if transmission_status['connected'] else "❌"
     transmission_text = "Connected" if transmission_status['connected'] else "Disconnected"
-    webhook_mode = 'Enabled' if WEBHOOK_MODE else 'Disabled (Polling)'
     
     # Build transmission details section
     transmission_details = ""
     if transmission_status['connected']:
-        transmission_details = """
-        <div class="status-row">
-            <div class="status-label">Version:</div>
-            <div class="status-value">{{VERSION}}</div>
-        </div>
-        <div class="status-row">
-            <div class="status-label">Download Directory:</div>
-            <div class="status-value">{{DOWNLOAD_DIR}}</div>
-        </div>
-        <div class="status-row">
-            <div class="status-label">Active Torrents:</div>
-            <div class="status-value">{{ACTIVE_TORRENTS}}</div>
-        </div>"""
-        transmission_details = transmission_details.replace('{{VERSION}}', str(transmission_status['version']))
-        transmission_details = transmission_details.replace('{{DOWNLOAD_DIR}}', str(transmission_status['download_dir']))
-        transmission_details = transmission_details.replace('{{ACTIVE_TORRENTS}}', str(transmission_status['active_torrents']))
+        transmission_details = _TRANSMISSION_DETAILS_TEMPLATE.substitute(
+            VERSION=str(transmission_status['version']),
+            DOWNLOAD_DIR=str(transmission_status['download_dir']),
+            ACTIVE_TORRENTS=str(transmission_status['active_torrents']),
+        )
     
     # Build error section
     error_section = ""
     if transmission_status['error']:
-        error_section = """
-        <div class="error-box">
-            <strong>Connection Error:</strong><br>
-            {{ERROR_MESSAGE}}
-        </div>"""
-        error_section = error_section.replace('{{ERROR_MESSAGE}}', str(transmission_status['error']))
+        error_section = _ERROR_SECTION_TEMPLATE.substitute(
+            ERROR_MESSAGE=str(transmission_status['error']))
     
     # Substitute values in template
-    html = html.replace('{{APP_STATUS}}', app_status)
-    html = html.replace('{{WEBHOOK_MODE}}', webhook_mode)
-    html = html.replace('{{TRANSMISSION_ICON}}', transmission_icon)
-    html = html.replace('{{TRANSMISSION_TEXT}}', transmission_text)
-    html = html.replace('{{TRANSMISSION_DETAILS}}', transmission_details)
-    html = html.replace('{{ERROR_SECTION}}', error_section)
-    
-    return html
+    return _STATUS_TEMPLATE.substitute({
+        'APP_STATUS': app_status,
+        'TRANSMISSION_ICON': transmission_icon,
+        'TRANSMISSION_TEXT': transmission_text,
+        'TRANSMISSION_DETAILS': transmission_details,
+        'ERROR_SECTION': error_section,
+    })
 
 
 
@@ -203,12 +272,12 @@ async def setup_webhook(application):
     try:
         await application.bot.set_webhook(
             url=WEBHOOK_URL,
-            allowed_updates=["message", "callback_query"],
+            allowed_updates=ALLOWED_UPDATES,
             secret_token=WEBHOOK_SECRET_TOKEN
         )
-        logger.info(f"Webhook set to {WEBHOOK_URL}")
+        logger.info("Webhook set to %s", WEBHOOK_URL)
     except Exception as e:
-        logger.error(f"Failed to set webhook: {e}")
+        logger.error("Failed to set webhook: %s", e)
         raise
 
 
@@ -218,69 +287,208 @@ async def remove_webhook(application):
         await application.bot.delete_webhook()
         logger.info("Webhook removed")
     except Exception as e:
-        logger.error(f"Failed to remove webhook: {e}")
-
+        logger.error("Failed to remove webhook: %s", e)
+
+
+class TransmissionAsyncClient:
+    """Transmission JSON-RPC client on one pooled aiohttp session.
+
+    Speaks the RPC directly instead of going through transmission_rpc's
+    blocking requests transport, so calls need no thread hop and share
+    warm keep-alive connections. transmission_rpc is still used for its
+    Torrent model and error types."""
+
+    SESSION_ID_HEADER = 'X-Transmission-Session-Id'
+
+    def __init__(self, url: str, username: str | None, password: str | None):
+        parsed_url = urlparse(url)
+        self.host = parsed_url.hostname or 'localhost'
+        self.port = parsed_url.port or 9091
+        protocol = 'https' if parsed_url.scheme == 'https' else 'http'
+        self._url = f"{protocol}://{self.host}:{self.port}/transmission/rpc"
+        self._auth = (aiohttp.BasicAuth(username or '', password or '')
+                      if username or password else None)
+        self._http: aiohttp.ClientSession | None = None
+        # CSRF token Transmission hands out with a 409; reused until the
+        # daemon restarts and answers 409 again.
+        self._session_id = ''
+        self.connected = False
+        # Reconnect backoff: after the n-th failed connect in a row, wait
+        # min(60, 2**n) seconds before trying again, so a Transmission restart
+        # self-heals without the bot hammering a daemon that is down.
+        self._next_retry = 0.0
+        self._fail_count = 0
+        self._connect_lock = asyncio.Lock()
+        # (monotonic time, status dict) of the last snapshot; see
+        # get_status_snapshot.
+        self._status_cache = (0.0, None)
+        self._status_lock = asyncio.Lock()
+
+    def _get_http(self) -> aiohttp.ClientSession:
+        # Created lazily: an aiohttp session must be made inside the running
+        # event loop, which doesn't exist yet at import time.
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=30),
+                auth=self._auth,
+            )
+        return self._http
 
-class TransmissionClient:
-    """Transmission RPC client wrapper"""
-    
-    def __init__(self):
-        self.client = None
-        self._connect()
-    
-    def _connect(self):
-        """Connect to Transmission daemon"""
+    async def _rpc(self, method: str, arguments: dict | None = None) -> dict:
+        """Send one RPC request and return its 'arguments'."""
+        body = {'method': method, 'arguments': arguments or {}}
+        http = self._get_http()
         try:
-            parsed_url = urlparse(TRANSMISSION_URL)
-            host = parsed_url.hostname or 'localhost'
-            port = parsed_url.port or 9091
-            
-            self.client = transmission_rpc.Client(
-                host=host,
-                port=port,
-                username=TRANSMISSION_USER,
-                password=TRANSMISSION_PASS
-            )
-            logger.info(f"Connected to Transmission at {host}:{port}")
+            # Second attempt only after a 409 handed us a fresh session id.
+            for _ in range(2):
+                async with http.post(self._url, json=body, headers={
+                        self.SESSION_ID_HEADER: self._session_id}) as resp:
+                    if resp.status == 409:
+                        self._session_id = resp.headers.get(self.SESSION_ID_HEADER, '')
+                        continue
+                    if resp.status in (401, 403):
+                        raise TransmissionAuthError(
+                            "transmission daemon require auth", method=method)
+                    if resp.status != 200:
+                        raise TransmissionError(
+                            f"HTTP {resp.status} from transmission daemon", method=method)
+                    data = await resp.json(loads=orjson.loads, content_type=None)
+                break
+            else:
+                raise TransmissionError(
+                    "transmission daemon kept rejecting the session id", method=method)
+        except asyncio.TimeoutError as e:
+            self.connected = False
+            raise TransmissionTimeoutError(
+                "timeout when connection to transmission daemon", method=method) from e
+        except aiohttp.ClientError as e:
+            self.connected = False
+            raise TransmissionConnectError(
+                f"can't connect to transmission daemon: {e!s}", method=method) from e
+
+        if data.get('result') != 'success':
+            raise TransmissionError(
+                f'Query failed with result "{data.get("result")}"', method=method,
+                argument=arguments, response=data)
+        return data.get('arguments', {})
+
+    async def _connect(self) -> None:
+        """Connect to Transmission daemon (session-get handshake)"""
+        try:
+            await self._rpc('session-get', {'fields': ['version']})
+            self.connected = True
+            logger.info("Connected to Transmission at %s:%s", self.host, self.port)
         except Exception as e:
-            logger.error(f"Failed to connect to Transmission: {e}")
-            self.client = None
-    
-    def get_download_dirs(self) -> Dict[str, str]:
-        """Get available download directories from Transmission or use defaults"""
-        if not self.client:
-            logger.warning("Transmission client not available, using default directories")
-            return DEFAULT_DOWNLOAD_DIRS
+            logger.error("Failed to connect to Transmission: %s", e)
+            self.connected = False
+
+    async def ensure_connected(self) -> bool:
+        """Return whether Transmission is reachable, reconnecting when due"""
+        if self.connected or time.monotonic() < self._next_retry:
+            return self.connected
+        # One reconnect attempt at a time: health probes, /status and
+        # handlers arriving together while the daemon is down would
+        # otherwise each start their own handshake.
+        async with self._connect_lock:
+            if not self.connected and time.monotonic() >= self._next_retry:
+                await self._connect()
+                if self.connected:
+                    self._fail_count = 0
+                else:
+                    self._fail_count += 1
+                    self._next_retry = time.monotonic() + min(60, 2 ** self._fail_count)
+        return self.connected
+
+    async def get_status_snapshot(self, ttl: float = _STATUS_TTL) -> dict:
+        """Connection status and details, reusing the last snapshot for ttl
+        seconds. Only one caller refreshes at a time; while a refresh is in
+        flight (e.g. Transmission stalling) the others get the previous
+        snapshot instead of piling up behind it."""
+        ts, status = self._status_cache
+        if status is not None and (time.monotonic() - ts < ttl
+                                   or self._status_lock.locked()):
+            return status
+        async with self._status_lock:
+            ts, status = self._status_cache
+            if status is None or time.monotonic() - ts >= ttl:
+                status = await self._fetch_status()
+                self._status_cache = (time.monotonic(), status)
+            return status
+
+    async def fetch_status_bundle(self) -> tuple[dict, dict]:
+        """session-get and torrent-get(ids) issued concurrently: the two
+        requests overlap on pooled connections instead of costing two
+        sequential round-trips."""
+        session, torrents = await asyncio.gather(
+            self._rpc('session-get', {'fields': ['version', 'download-dir']}),
+            # Only the count is needed: fetch ids, not every field of
+            # every torrent.
+            self._rpc('torrent-get', {'fields': ['id']}),
+        )
+        return session, torrents
+
+    async def _fetch_status(self) -> dict:
+        status = {
+            'connected': False,
+            'error': None,
+            'version': None,
+            'download_dir': None,
+            'active_torrents': 0
+        }
         
         try:
-            # Try to get session info for download directories
-            session = self.client.get_session()
-            download_dir = getattr(session, 'download_dir', '/downloads')
-            
-            # For now, use default categories with the base download dir
-            dirs = {}
-            for label, subdir in DEFAULT_DOWNLOAD_DIRS.items():
-                dirs[label] = subdir
-            
-            return dirs
+            if await self.ensure_connected():
+                session, torrents = await self.fetch_status_bundle()
+                status['connected'] = True
+                status['version'] = session.get('version')
+                status['download_dir'] = session.get('download-dir')
+                status['active_torrents'] = len(torrents.get('torrents', []))
+            else:
+                status['error'] = 'Transmission client not initialized'
         except Exception as e:
-            logger.error(f"Failed to get download directories: {e}")
-            return DEFAULT_DOWNLOAD_DIRS
+            status['error'] = str(e)
+        
+        return status
     
-    def add_torrent(self, magnet_url: str, download_dir: str) -> Optional['transmission_rpc.Torrent']:
+    def get_download_dirs(self) -> Mapping[str, str]:
+        """Get available download directories from Transmission or use defaults"""
+        if not self.connected:
+            logger.warning("Transmission client not available, using default directories")
+        # For now, always the default categories. Returned as-is, not copied:
+        # it is a read-only proxy.
+        return DEFAULT_DOWNLOAD_DIRS
+    
+    async def add_torrent(self, magnet_url: str, download_dir: str) -> transmission_rpc.Torrent | None:
         """Add magnet link to Transmission"""
-        if not self.client:
+        if not await self.ensure_connected():
             logger.error("Transmission client not available")
             return None
 
         try:
-            torrent = self.client.add_torrent(magnet_url, download_dir=download_dir)
-            logger.info(f"Added torrent: {torrent.name} to {download_dir}")
+            result = await self._rpc(
+                'torrent-add', {'filename': magnet_url, 'download-dir': download_dir})
+            # 'torrent-added', or 'torrent-duplicate' if it was already there.
+            torrent = transmission_rpc.Torrent(fields=next(iter(result.values())))
+            logger.info("Added torrent: %s to %s", torrent.name, download_dir)
             return torrent
         except Exception as e:
-            logger.error(f"Failed to add torrent: {e}")
+            logger.error("Failed to add torrent: %s", e)
             return None
 
+    async def get_torrent(self, torrent_id: int,
+                          fields: list[str]) -> transmission_rpc.Torrent | None:
+        """Fetch the given fields of one torrent; None if it no longer exists"""
+        result = await self._rpc(
+            'torrent-get', {'ids': [torrent_id], 'fields': ['id', *fields]})
+        torrents = result.get('torrents', [])
+        return transmission_rpc.Torrent(fields=torrents[0]) if torrents else None
+
+    async def close(self) -> None:
+        """Close the pooled HTTP session to Transmission."""
+        if self._http is not None:
+            await self._http.close()
+
 
 @dataclass
 class RuTrackerTorrent:
@@ -305,7 +513,7 @@ class RuTrackerTorrent:
 class TopicDetails:
     """One topic page's payload: the magnet link plus the cleaned text of
     the first (release) post — header + description, no media/spoilers."""
-    magnet: Optional[str]
+    magnet: str | None
     info: str
 
 
@@ -360,7 +568,7 @@ class RuTrackerClient:
     TRANSIENT_HTTP = {500, 502, 503, 504, 520, 521, 522, 523, 524}
 
     def __init__(self):
-        self.session: Optional[http_requests.Session] = None
+        self.session: http_requests.Session | None = None
         self._authed = False
         # This client is a shared singleton hit from many asyncio.to_thread
         # workers at once. session/_authed are mutated by _ensure_logged_in
@@ -388,13 +596,13 @@ class RuTrackerClient:
                     return resp
                 last = f"HTTP {resp.status_code}"
             logger.warning(
-                f"RuTracker {method} {path!r} attempt "
-                f"{i + 1}/{self.RETRY_ATTEMPTS}: {last}")
+                "RuTracker %s %r attempt %s/%s: %s",
+                method, path, i + 1, self.RETRY_ATTEMPTS, last)
             if i + 1 < self.RETRY_ATTEMPTS:
                 time.sleep(1 + i)  # 1s, then 2s
         raise RuTrackerUnavailable(str(last))
 
-    def _get(self, path: str, params: Optional[dict] = None):
+    def _get(self, path: str, params: dict | None = None):
         return self._request("GET", path, params=params)
 
     @staticmethod
@@ -421,7 +629,7 @@ class RuTrackerClient:
                 "login": "Вход",
             }, allow_redirects=True)
         except RuTrackerUnavailable as exc:
-            logger.error(f"RuTracker login request failed: {exc}")
+            logger.error("RuTracker login request failed: %s", exc)
             self.session = None
             return False
         if self._is_authed(resp.text):
@@ -436,11 +644,11 @@ class RuTrackerClient:
         self.session = None
         self._authed = False
 
-    def search(self, query: str) -> List[RuTrackerTorrent]:
+    def search(self, query: str) -> list[RuTrackerTorrent]:
         with self._lock:
             return self._search(query)
 
-    def _search(self, query: str) -> List[RuTrackerTorrent]:
+    def _search(self, query: str) -> list[RuTrackerTorrent]:
         if not self._ensure_logged_in():
             raise RuTrackerUnavailable("login failed")
         resp = self._get("tracker.php", {"nm": query})
@@ -496,17 +704,17 @@ class RuTrackerClient:
             ))
         return results
 
-    def get_topic(self, topic_id: str) -> Optional[TopicDetails]:
+    def get_topic(self, topic_id: str) -> TopicDetails | None:
         with self._lock:
             return self._get_topic(topic_id)
 
-    def _get_topic(self, topic_id: str) -> Optional[TopicDetails]:
+    def _get_topic(self, topic_id: str) -> TopicDetails | None:
         """Fetch a topic page once and return its magnet + first-post text.
         Returns None only if the page could not be fetched (network/login);
         a fetched page with no magnet still returns TopicDetails so the
         info text can be shown."""
         if not self._ensure_logged_in():
-            logger.error(f"RuTracker get_topic t={topic_id}: login failed")
+            logger.error("RuTracker get_topic t=%s: login failed", topic_id)
             return None
         try:
             resp = self._get(f"viewtopic.php?t={topic_id}")
@@ -516,11 +724,11 @@ class RuTrackerClient:
                 self._drop_session()
                 if not self._ensure_logged_in():
                     logger.error(
-                        f"RuTracker get_topic t={topic_id}: re-login failed")
+                        "RuTracker get_topic t=%s: re-login failed", topic_id)
                     return None
                 resp = self._get(f"viewtopic.php?t={topic_id}")
         except RuTrackerUnavailable as exc:
-            logger.error(f"RuTracker get_topic t={topic_id} failed: {exc}")
+            logger.error("RuTracker get_topic t=%s failed: %s", topic_id, exc)
             return None
         resp.encoding = "windows-1251"
         soup = BeautifulSoup(resp.text, "lxml")
@@ -528,9 +736,9 @@ class RuTrackerClient:
         magnet = link.get("href") if link else None
         if not magnet:
             logger.error(
-                f"RuTracker get_topic t={topic_id}: no magnet link "
-                f"(authed={self._is_authed(resp.text)}, "
-                f"{len(resp.text)} bytes)")
+                "RuTracker get_topic t=%s: no magnet link "
+                "(authed=%s, %s bytes)",
+                topic_id, self._is_authed(resp.text), len(resp.text))
         # First .post_body is the release (OP); later ones are comments.
         info = _extract_post_text(soup.select_one("div.post_body"))
         return TopicDetails(magnet=magnet, info=info)
@@ -670,7 +878,7 @@ class LLMClient:
             timeout=(10, 300),
         )
         resp.raise_for_status()
-        parts: List[str] = []
+        parts: list[str] = []
         for line in resp.iter_lines(decode_unicode=True):
             if not line or not line.startswith("data:"):
                 continue
@@ -695,7 +903,7 @@ class LLMClient:
         return (clean_q or raw_query), category
 
     def filter_results(self, query: str, category: str,
-                       items: List['RuTrackerTorrent']) -> List[int]:
+                       items: list['RuTrackerTorrent']) -> list[int]:
         """Return indices of items matching the desired category."""
         lines = [f"Пользователь искал: {query}",
                  f"Желаемый тип: {category}", "", "Раздачи:"]
@@ -712,7 +920,7 @@ class LLMClient:
         return out
 
     def classify_results(self, query: str,
-                         items: List['RuTrackerTorrent']) -> Dict[int, str]:
+                         items: list['RuTrackerTorrent']) -> dict[int, str]:
         """Classify every item into one of CATEGORY_TO_DIR's categories.
         Returns {index: category} covering all items ('other' as fallback)."""
         lines = [f"Пользователь искал: {query}", "", "Раздачи:"]
@@ -721,7 +929,7 @@ class LLMClient:
         data = _extract_json(self._chat(_CLASSIFY_SYSTEM, "\n".join(lines)))
 
         allowed = set(CATEGORY_TO_DIR)
-        out: Dict[int, str] = {}
+        out: dict[int, str] = {}
         pairs = []
         if isinstance(data, dict):
             pairs = list(data.items())
@@ -746,7 +954,8 @@ class LLMClient:
 
 
 # Global clients
-transmission_client = TransmissionClient()
+transmission_client = TransmissionAsyncClient(
+    TRANSMISSION_URL, TRANSMISSION_USER, TRANSMISSION_PASS)
 rutracker_client = RuTrackerClient()
 llm_client = (
     LLMClient(AI_LLM_API_BASE_URL, AI_LLM_API_KEY, AI_LLM_MODEL,
@@ -755,11 +964,11 @@ llm_client = (
 )
 
 
-def _get_torrent_job_store(application: Application) -> Dict[int, object]:
+def _get_torrent_job_store(application: Application) -> dict[int, object]:
     return application.bot_data.setdefault(TORRENT_JOBS_KEY, {})
 
 
-def _remove_torrent_job(application: Application, torrent_id: Optional[int], active_job=None) -> None:
+def _remove_torrent_job(application: Application, torrent_id: int | None, active_job=None) -> None:
     if torrent_id is None:
         return
     jobs = application.bot_data.get(TORRENT_JOBS_KEY)
@@ -770,17 +979,17 @@ def _remove_torrent_job(application: Application, torrent_id: Optional[int], act
         job.schedule_removal()
 
 
-def _remove_torrent_task(torrent_id: Optional[int]) -> None:
+def _remove_torrent_task(torrent_id: int | None) -> None:
     """Remove and cancel a torrent monitoring task."""
     if torrent_id is None:
         return
     task = _torrent_monitor_tasks.pop(torrent_id, None)
     if task and not task.done():
         task.cancel()
-        logger.debug(f"Cancelled and removed monitor task for torrent {torrent_id}")
+        logger.debug("Cancelled and removed monitor task for torrent %s", torrent_id)
 
 
-def schedule_torrent_monitor(application: Application, torrent_id: Optional[int], chat_id: int,
+def schedule_torrent_monitor(application: Application, torrent_id: int | None, chat_id: int,
                              torrent_name: str, download_path: str) -> None:
     """Schedule periodic checks for a torrent completion."""
     if torrent_id is None:
@@ -790,7 +999,7 @@ def schedule_torrent_monitor(application: Application, torrent_id: Optional[int]
     # Cancel existing monitoring task if present
     if torrent_id in _torrent_monitor_tasks:
         _torrent_monitor_tasks[torrent_id].cancel()
-        logger.debug(f"Cancelled existing monitor task for torrent {torrent_id}")
+        logger.debug("Cancelled existing monitor task for torrent %s", torrent_id)
 
     # Create a new asyncio task for monitoring
     task = asyncio.create_task(
@@ -803,7 +1012,7 @@ def schedule_torrent_monitor(application: Application, torrent_id: Optional[int]
         )
     )
     _torrent_monitor_tasks[torrent_id] = task
-    logger.info(f"Scheduled torrent monitor for torrent {torrent_id}")
+    logger.info("Scheduled torrent monitor for torrent %s", torrent_id)
 
 
 async def _monitor_torrent_loop(application: Application, torrent_id: int, chat_id: int,
@@ -813,32 +1022,33 @@ async def _monitor_torrent_loop(application: Application, torrent_id: int, chat_
         while True:
             await asyncio.sleep(TORRENT_POLL_INTERVAL)
             
-            if not transmission_client.client:
+            if not await transmission_client.ensure_connected():
                 logger.debug("Transmission client not connected; will retry later")
                 continue
 
             try:
-                torrent = transmission_client.client.get_torrent(torrent_id)
+                torrent = await transmission_client.get_torrent(
+                    torrent_id, TORRENT_MONITOR_FIELDS)
             except TransmissionError as exc:
-                if '404: Not Found' in str(exc):
-                    logger.info(f"Torrent {torrent_id} appears to be removed before completion")
-                    try:
-                        await application.bot.send_message(
-                            chat_id=chat_id,
-                            text=f"⚠️ Torrent removed before completion:\n{torrent_name}"
-                        )
-                    except Exception as send_exc:
-                        logger.error(f"Failed to send removal notification for torrent {torrent_id}: {send_exc}")
-                    finally:
-                        _remove_torrent_task(torrent_id)
-                    break
-                else:
-                    logger.warning(f"Failed to fetch torrent {torrent_id}: {exc}")
+                logger.warning("Failed to fetch torrent %s: %s", torrent_id, exc)
                 continue
             except Exception as exc:
-                logger.error(f"Unexpected error retrieving torrent {torrent_id}: {exc}")
+                logger.error("Unexpected error retrieving torrent %s: %s", torrent_id, exc)
                 continue
 
+            if torrent is None:
+                logger.info("Torrent %s appears to be removed before completion", torrent_id)
+                try:
+                    await application.bot.send_message(
+                        chat_id=chat_id,
+                        text=f"⚠️ Torrent removed before completion:\n{torrent_name}"
+                    )
+                except Exception as send_exc:
+                    logger.error("Failed to send removal notification for torrent %s: %s", torrent_id, send_exc)
+                finally:
+                    _remove_torrent_task(torrent_id)
+                break
+
             progress = getattr(torrent, 'progress', None)
             percent_done = getattr(torrent, 'percent_done', None)
             status = getattr(torrent, 'status', '').lower()
@@ -867,13 +1077,13 @@ async def _monitor_torrent_loop(application: Application, torrent_id: int, chat_
             try:
                 await application.bot.send_message(chat_id=chat_id, text='\n'.join(message_lines))
             except Exception as exc:
-                logger.error(f"Failed to send completion notification for torrent {torrent_id}: {exc}")
+                logger.error("Failed to send completion notification for torrent %s: %s", torrent_id, exc)
             finally:
                 _remove_torrent_task(torrent_id)
             break
             
     except asyncio.CancelledError:
-        logger.debug(f"Torrent monitor task for {torrent_id} was cancelled")
+        logger.debug("Torrent monitor task for %s was cancelled", torrent_id)
         raise
 
 
@@ -900,31 +1110,33 @@ async def monitor_torrent_completion(context: ContextTypes.DEFAULT_TYPE) -> None
             _remove_torrent_job(context.application, torrent_id, active_job=job)
         return
 
-    if not transmission_client.client:
+    if not await transmission_client.ensure_connected():
         logger.debug("Transmission client not connected; will retry later")
         return
 
     try:
-        torrent = transmission_client.client.get_torrent(torrent_id)
+        torrent = await transmission_client.get_torrent(
+            torrent_id, TORRENT_MONITOR_FIELDS)
     except TransmissionError as exc:
-        if '404: Not Found' in str(exc):
-            logger.info(f"Torrent {torrent_id} appears to be removed before completion")
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⚠️ Torrent removed before completion:\n{torrent_name}"
-                )
-            except Exception as send_exc:
-                logger.error(f"Failed to send removal notification for torrent {torrent_id}: {send_exc}")
-            finally:
-                job.schedule_removal()
-                if context.application:
-                    _remove_torrent_job(context.application, torrent_id, active_job=job)
-        else:
-            logger.warning(f"Failed to fetch torrent {torrent_id}: {exc}")
+        logger.warning("Failed to fetch torrent %s: %s", torrent_id, exc)
         return
     except Exception as exc:
-        logger.error(f"Unexpected error retrieving torrent {torrent_id}: {exc}")
+        logger.error("Unexpected error retrieving torrent %s: %s", torrent_id, exc)
+        return
+
+    if torrent is None:
+        logger.info("Torrent %s appears to be removed before completion", torrent_id)
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"⚠️ Torrent removed before completion:\n{torrent_name}"
+            )
+        except Exception as send_exc:
+            logger.error("Failed to send removal notification for torrent %s: %s", torrent_id, send_exc)
+        finally:
+            job.schedule_removal()
+            if context.application:
+                _remove_torrent_job(context.application, torrent_id, active_job=job)
         return
 
     progress = getattr(torrent, 'progress', None)
@@ -955,81 +1167,102 @@ async def monitor_torrent_completion(context: ContextTypes.DEFAULT_TYPE) -> None
     try:
         await context.bot.send_message(chat_id=chat_id, text='\n'.join(message_lines))
     except Exception as exc:
-        logger.error(f"Failed to send completion notification for torrent {torrent_id}: {exc}")
+        logger.error("Failed to send completion notification for torrent %s: %s", torrent_id, exc)
     finally:
         job.schedule_removal()
         if context.application:
             _remove_torrent_job(context.application, torrent_id, active_job=job)
 
 
+# Static replies, built once: the RuTracker parts depend only on config.
+_SEARCH_HINT = "\n📝 Или просто напишите название — поищу на RuTracker!" if RUTRACKER_USERNAME else ""
+WELCOME_MESSAGE = (
+    "🤖 Welcome to Torrent Bot!\n\n"
+    "Send me a magnet link and I'll help you download it via Transmission.\n"
+    f"{_SEARCH_HINT}\n\n"
+    "Commands:\n"
+    "/start - Show this welcome message\n"
+    "/help - Show help information\n"
+    "/status - Check Transmission connection status"
+)
+
+_SEARCH_SECTION = (
+    "\n🔍 Поиск на RuTracker:\n"
+    "1. Напишите название (например: Семь самураев)\n"
+    "2. Выберите раздел\n"
+    "3. Выберите раздачу\n"
+    "4. Выберите папку для скачивания\n"
+) if RUTRACKER_USERNAME else ""
+HELP_TEXT = (
+    "📖 How to use Torrent Bot:\n\n"
+    "🧲 Magnet-ссылки:\n"
+    "1. Send me a magnet link\n"
+    "2. Choose a download category from the buttons\n"
+    "3. I'll add it to Transmission for you!\n"
+    f"{_SEARCH_SECTION}\n"
+    "Available categories:\n"
+    "🎬 Movies\n📺 TV Shows\n📚 Books\n🎵 Music\n🎮 Games\n📁 Other"
+)
+
+NO_MAGNET_MESSAGE = (
+    "I didn't find any magnet links in your message. "
+    "Please send a valid magnet link starting with 'magnet:?'"
+)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
-    search_hint = "\n📝 Или просто напишите название — поищу на RuTracker!" if RUTRACKER_USERNAME else ""
-    welcome_message = (
-        "🤖 Welcome to Torrent Bot!\n\n"
-        "Send me a magnet link and I'll help you download it via Transmission.\n"
-        f"{search_hint}\n\n"
-        "Commands:\n"
-        "/start - Show this welcome message\n"
-        "/help - Show help information\n"
-        "/status - Check Transmission connection status"
-    )
-    await update.message.reply_text(welcome_message)
+    await update.message.reply_text(WELCOME_MESSAGE)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
-    search_section = (
-        "\n🔍 Поиск на RuTracker:\n"
-        "1. Напишите название (например: Семь самураев)\n"
-        "2. Выберите раздел\n"
-        "3. Выберите раздачу\n"
-        "4. Выберите папку для скачивания\n"
-    ) if RUTRACKER_USERNAME else ""
-    help_text = (
-        "📖 How to use Torrent Bot:\n\n"
-        "🧲 Magnet-ссылки:\n"
-        "1. Send me a magnet link\n"
-        "2. Choose a download category from the buttons\n"
-        "3. I'll add it to Transmission for you!\n"
-        f"{search_section}\n"
-        "Available categories:\n"
-        "🎬 Movies\n📺 TV Shows\n📚 Books\n🎵 Music\n🎮 Games\n📁 Other"
-    )
-    await update.message.reply_text(help_text)
+    await update.message.reply_text(HELP_TEXT)
 
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Check Transmission connection status."""
-    try:
-        if transmission_client.client:
-            session = transmission_client.client.get_session()
-            status_text = (
-                "✅ Transmission Status: Connected\n"
-                f"Version: {session.version}\n"
-                f"Download directory: {session.download_dir}\n"
-                f"Active torrents: {len(transmission_client.client.get_torrents())}"
-            )
-        else:
-            status_text = "❌ Transmission Status: Disconnected"
-    except Exception as e:
-        status_text = f"❌ Transmission Status: Error - {str(e)}"
+    status = await get_transmission_status()
+    if status['connected']:
+        status_text = (
+            "✅ Transmission Status: Connected\n"
+            f"Version: {status['version']}\n"
+            f"Download directory: {status['download_dir']}\n"
+            f"Active torrents: {status['active_torrents']}"
+        )
+    elif transmission_client.connected:
+        status_text = f"❌ Transmission Status: Error - {status['error']}"
+    else:
+        status_text = "❌ Transmission Status: Disconnected"
     
     await update.message.reply_text(status_text)
 
 
-def extract_magnet_links(message_text: str) -> List[str]:
+def extract_magnet_links(message_text: str) -> list[str]:
     """Extract magnet links from message text."""
-    return MAGNET_PATTERN.findall(message_text)
+    # Most messages are search queries; a literal substring test is far
+    # cheaper than running the regex over them.
+    return _MAGNET_FIND(message_text) if 'magnet:?' in message_text else []
 
 
 def _build_download_keyboard() -> InlineKeyboardMarkup:
-    download_dirs = transmission_client.get_download_dirs()
-    keyboard = [[InlineKeyboardButton(label, callback_data=f"download:{path}")]
-                for label, path in download_dirs.items()]
+    keyboard = [[InlineKeyboardButton(label, callback_data=f"d:{i}")]
+                for i, (label, _path) in enumerate(_DIRS_ITEMS)]
     return InlineKeyboardMarkup(keyboard)
 
 
+def _build_pick_dir_keyboard(dirs: Mapping[str, str]) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(label, callback_data=f"rt_setdir:{path}")]
+            for label, path in dirs.items()]
+    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="rt_prev")])
+    return InlineKeyboardMarkup(rows)
+
+
+# Both folder keyboards are the same for every user; build them once.
+_DEFAULT_KEYBOARD = _build_download_keyboard()
+_DEFAULT_PICK_DIR_KEYBOARD = _build_pick_dir_keyboard(DEFAULT_DOWNLOAD_DIRS)
+
+
 SMART_TOP_LIMIT = 25
 
 
@@ -1039,11 +1272,11 @@ def _torrent_button_label(t: 'RuTrackerTorrent') -> str:
     return f"{t.title[:42]} · {t.size_human} {seed_str}"
 
 
-async def _show_forum_groups(edit, results: List['RuTrackerTorrent'],
+async def _show_forum_groups(edit, results: list['RuTrackerTorrent'],
                              context: ContextTypes.DEFAULT_TYPE,
                              note: str = "") -> None:
     """Render the classic 'pick a forum section' screen."""
-    groups: Dict[str, List[RuTrackerTorrent]] = defaultdict(list)
+    groups: dict[str, list[RuTrackerTorrent]] = defaultdict(list)
     for t in results:
         groups[t.forum].append(t)
     for lst in groups.values():
@@ -1073,7 +1306,7 @@ async def _show_forum_groups(edit, results: List['RuTrackerTorrent'],
     await edit("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-async def _show_smart_top(edit, selected: List['RuTrackerTorrent'],
+async def _show_smart_top(edit, selected: list['RuTrackerTorrent'],
                           context: ContextTypes.DEFAULT_TYPE,
                           category: str, total: int) -> None:
     """Render the LLM-filtered flat top list (sorted by seeds).
@@ -1107,7 +1340,7 @@ async def _show_smart_top(edit, selected: List['RuTrackerTorrent'],
     await edit(header, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-def _bucket_keyboard(buckets: List[dict]) -> List[List[InlineKeyboardButton]]:
+def _bucket_keyboard(buckets: list[dict]) -> list[list[InlineKeyboardButton]]:
     kb = [
         [InlineKeyboardButton(f"{b['label']} ({len(b['idxs'])})",
                               callback_data=f"rt_cat:{n}")]
@@ -1120,15 +1353,15 @@ def _bucket_keyboard(buckets: List[dict]) -> List[List[InlineKeyboardButton]]:
     return kb
 
 
-async def _show_category_buckets(edit, results: List['RuTrackerTorrent'],
+async def _show_category_buckets(edit, results: list['RuTrackerTorrent'],
                                   context: ContextTypes.DEFAULT_TYPE,
-                                  classification: Dict[int, str]) -> None:
+                                  classification: dict[int, str]) -> None:
     """Group results into the user's folders via LLM classification,
     instead of by raw RuTracker forums (used for the 'any' intent)."""
     context.user_data['rt_results'] = results
     context.user_data.pop('rt_category', None)
 
-    buckets: Dict[str, dict] = {}
+    buckets: dict[str, dict] = {}
     for i, t in enumerate(results):
         cat = classification.get(i, 'other')
         label = CATEGORY_TO_DIR.get(cat, CATEGORY_TO_DIR['other'])[0]
@@ -1167,12 +1400,12 @@ async def _reshow_buckets(query, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def _handle_bucket_selection(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        n = int(query.data.replace("rt_cat:", ""))
+        n = int(query.data.partition(":")[2])
     except ValueError:
         await query.edit_message_text("❌ Некорректный выбор.")
         return
     buckets = context.user_data.get('rt_buckets', [])
-    results: List[RuTrackerTorrent] = context.user_data.get('rt_results', [])
+    results: list[RuTrackerTorrent] = context.user_data.get('rt_results', [])
     if not buckets or not results or not (0 <= n < len(buckets)):
         await query.edit_message_text(
             "❌ Результаты поиска устарели. Попробуйте снова.")
@@ -1212,37 +1445,53 @@ async def _rt_search(msg, query: str):
     try:
         results = await asyncio.to_thread(rutracker_client.search, query)
     except RuTrackerUnavailable as exc:
-        logger.error(f"RuTracker unavailable for {query!r}: {exc}")
+        logger.error("RuTracker unavailable for %r: %s", query, exc)
         await msg.edit_text(
             "⚠️ RuTracker сейчас не ответил. "
             "Попробуй ещё раз через пару секунд.")
         return None
     if not results:
-        logger.info(f"RuTracker search {query!r}: 0 results")
+        logger.info("RuTracker search %r: 0 results", query)
         await msg.edit_text("Ничего не найдено.")
         return None
-    logger.info(f"RuTracker search {query!r}: {len(results)} results")
+    logger.info("RuTracker search %r: %s results", query, len(results))
     return results
 
 
+def _store_pending_magnets(user_id: int, magnet_links: list[str]) -> None:
+    global _PENDING
+    now = time.monotonic()
+    if len(_PENDING) > _PENDING_MAX:
+        _PENDING = {uid: entry for uid, entry in _PENDING.items()
+                    if now - entry[1] < _PENDING_TTL}
+    _PENDING[user_id] = (magnet_links, now)
+
+
+def _pop_pending_magnets(user_id: int) -> list[str] | None:
+    entry = _PENDING.pop(user_id, None)
+    if entry is None or time.monotonic() - entry[1] >= _PENDING_TTL:
+        return None
+    return entry[0]
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming messages: magnet links or search queries."""
     message_text = update.message.text if update.message.text else ""
     magnet_links = extract_magnet_links(message_text)
 
     if magnet_links:
-        context.user_data['magnet_link'] = magnet_links[0]
+        magnet_links = list(dict.fromkeys(magnet_links))  # drop repeats
+        _store_pending_magnets(update.effective_user.id, magnet_links)
+        found = ("🔍 Found magnet link!" if len(magnet_links) == 1
+                 else f"🔍 Found {len(magnet_links)} magnet links!")
         await update.message.reply_text(
-            "🔍 Found magnet link!\n\nPlease choose a download location:",
-            reply_markup=_build_download_keyboard(),
+            f"{found}\n\nPlease choose a download location:",
+            reply_markup=_DEFAULT_KEYBOARD,
         )
         return
 
     if not RUTRACKER_USERNAME or not RUTRACKER_PASSWORD:
-        await update.message.reply_text(
-            "I didn't find any magnet links in your message. "
-            "Please send a valid magnet link starting with 'magnet:?'"
-        )
+        await update.message.reply_text(NO_MAGNET_MESSAGE)
         return
 
     query = message_text.strip()
@@ -1266,10 +1515,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         clean_q, category = await asyncio.to_thread(
             llm_client.parse_intent, query)
     except Exception as exc:
-        logger.error(f"LLM intent parse failed: {exc}")
+        logger.error("LLM intent parse failed: %s", exc)
         clean_q, category, llm_failed = query, "any", True
-    logger.info(f"intent: {query!r} -> query={clean_q!r} "
-                f"category={category!r} llm_failed={llm_failed}")
+    logger.info("intent: %r -> query=%r category=%r llm_failed=%s",
+                query, clean_q, category, llm_failed)
 
     await msg.edit_text(f"🔍 Ищу '{clean_q}' на RuTracker…")
     results = await _rt_search(msg, clean_q)
@@ -1291,12 +1540,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             classification = await asyncio.to_thread(
                 llm_client.classify_results, clean_q, results)
         except Exception as exc:
-            logger.error(f"LLM classify failed: {exc}")
+            logger.error("LLM classify failed: %s", exc)
             classification = None
         if classification:
-            logger.info(
-                f"classify {clean_q!r}: "
-                f"{dict(Counter(classification.values()))}")
+            logger.info("classify %r: %s",
+                        clean_q, dict(Counter(classification.values())))
             await _show_category_buckets(
                 msg.edit_text, results, context, classification)
         else:
@@ -1310,11 +1558,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         rel = await asyncio.to_thread(
             llm_client.filter_results, clean_q, category, results)
     except Exception as exc:
-        logger.error(f"LLM filter failed: {exc}")
+        logger.error("LLM filter failed: %s", exc)
         rel = None
 
-    logger.info(f"filter {clean_q!r} cat={category!r}: "
-                f"kept {len(rel) if rel else 0}/{len(results)}")
+    logger.info("filter %r cat=%r: kept %s/%s",
+                clean_q, category, len(rel) if rel else 0, len(results))
     if not rel:
         await _show_forum_groups(
             msg.edit_text, results, context,
@@ -1338,10 +1586,10 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Callback already expired (e.g. user waited out a long RuTracker
         # retry storm). Non-fatal: we just can't dismiss the spinner —
         # still try to edit the message with the result below.
-        logger.info(f"callback answer skipped (stale query): {exc}")
+        logger.info("callback answer skipped (stale query): %s", exc)
 
     if data == "rt_groups":
-        results: List[RuTrackerTorrent] = context.user_data.get(
+        results: list[RuTrackerTorrent] = context.user_data.get(
             'rt_results', [])
         if not results:
             await query.edit_message_text(
@@ -1374,16 +1622,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await _handle_forum_selection(query, context)
     elif data.startswith("rt_torrent:"):
         await _handle_torrent_selection(query, context)
-    elif data.startswith("download:"):
+    elif data.startswith("d:") or data.startswith("download:"):
         await _handle_download_selection(query, context)
     else:
         await query.edit_message_text("❌ Invalid selection")
 
 
 async def _handle_forum_selection(query, context: ContextTypes.DEFAULT_TYPE) -> None:
-    choice = query.data.replace("rt_forum:", "")
-    results: List[RuTrackerTorrent] = context.user_data.get('rt_results', [])
-    forum_list: List[str] = context.user_data.get('rt_forums', [])
+    choice = query.data.partition(":")[2]
+    results: list[RuTrackerTorrent] = context.user_data.get('rt_results', [])
+    forum_list: list[str] = context.user_data.get('rt_forums', [])
 
     if not results:
         await query.edit_message_text("❌ Результаты поиска устарели. Попробуйте снова.")
@@ -1421,38 +1669,77 @@ async def _handle_forum_selection(query, context: ContextTypes.DEFAULT_TYPE) ->
         header, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+ADD_TORRENT_FAILED_TEXT = (
+    "❌ Не удалось добавить торрент в Transmission.\n\n"
+    "Проверьте:\n"
+    "- Transmission запущен и доступен\n"
+    "- Настройки подключения корректны"
+)
+
+
 async def _add_torrent_and_notify(query, context: ContextTypes.DEFAULT_TYPE,
                                   magnet_link: str, download_path: str,
-                                  dir_label: Optional[str] = None,
-                                  title: Optional[str] = None) -> None:
+                                  dir_label: str | None = None,
+                                  title: str | None = None) -> None:
     """Add the magnet to Transmission, start completion monitoring and
     report back. Shared by the auto-folder path and the manual picker."""
-    torrent = transmission_client.add_torrent(magnet_link, download_path)
+    # Clear pending magnets before the add is awaited: with concurrent
+    # updates, a link the user sends meanwhile must not be dropped after.
+    _PENDING.pop(query.from_user.id, None)
+    torrent = await transmission_client.add_torrent(magnet_link, download_path)
 
     if torrent:
-        chat_id = query.message.chat_id if query.message else query.from_user.id
-        torrent_id = getattr(torrent, 'id', None)
-        torrent_name = getattr(torrent, 'name', title or magnet_link)
-
-        if context.application:
-            schedule_torrent_monitor(
-                context.application, torrent_id, chat_id,
-                torrent_name, download_path,
-            )
-
+        _monitor_added_torrent(query, context, torrent, download_path,
+                               title or magnet_link)
         head = f"✅ Добавлено в Transmission → {dir_label or download_path}"
         if title:
             head += f"\n{title[:90]}"
         await query.edit_message_text(head + "\n\nСообщу когда скачается.")
     else:
+        await query.edit_message_text(ADD_TORRENT_FAILED_TEXT)
+
+
+async def _add_torrents_and_notify(query, context: ContextTypes.DEFAULT_TYPE,
+                                   magnet_links: list[str],
+                                   download_path: str) -> None:
+    """Add every magnet from one message. transmission-rpc has no batch
+    call, so the adds run concurrently over the pooled keep-alive session."""
+    torrents = await asyncio.gather(*(
+        transmission_client.add_torrent(magnet_link, download_path)
+        for magnet_link in magnet_links
+    ))
+
+    added = []
+    for magnet_link, torrent in zip(magnet_links, torrents):
+        if torrent:
+            added.append(_monitor_added_torrent(
+                query, context, torrent, download_path, magnet_link))
+
+    if added:
+        lines = [f"✅ Добавлено в Transmission → {download_path}: "
+                 f"{len(added)} из {len(magnet_links)}"]
+        lines.extend(f"• {name[:90]}" for name in added[:20])
+        if len(added) > 20:
+            lines.append("…")
         await query.edit_message_text(
-            "❌ Не удалось добавить торрент в Transmission.\n\n"
-            "Проверьте:\n"
-            "- Transmission запущен и доступен\n"
-            "- Настройки подключения корректны"
-        )
+            "\n".join(lines) + "\n\nСообщу когда скачается.")
+    else:
+        await query.edit_message_text(ADD_TORRENT_FAILED_TEXT)
 
-    context.user_data.pop('magnet_link', None)
+
+def _monitor_added_torrent(query, context: ContextTypes.DEFAULT_TYPE, torrent,
+                           download_path: str, fallback_name: str) -> str:
+    """Start completion monitoring for a just-added torrent; returns its name."""
+    chat_id = query.message.chat_id if query.message else query.from_user.id
+    torrent_id = getattr(torrent, 'id', None)
+    torrent_name = getattr(torrent, 'name', fallback_name)
+
+    if context.application:
+        schedule_torrent_monitor(
+            context.application, torrent_id, chat_id,
+            torrent_name, download_path,
+        )
+    return torrent_name
 
 
 async def _handle_torrent_selection(query, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1460,12 +1747,12 @@ async def _handle_torrent_selection(query, context: ContextTypes.DEFAULT_TYPE) -
     + description) with download/back buttons, instead of grabbing the
     magnet and downloading straight away."""
     try:
-        idx = int(query.data.replace("rt_torrent:", ""))
+        idx = int(query.data.partition(":")[2])
     except ValueError:
         await query.edit_message_text("❌ Некорректный выбор.")
         return
 
-    selected: List[RuTrackerTorrent] = context.user_data.get('rt_selected', [])
+    selected: list[RuTrackerTorrent] = context.user_data.get('rt_selected', [])
     if idx < 0 or idx >= len(selected):
         await query.edit_message_text("❌ Некорректный выбор.")
         return
@@ -1533,7 +1820,7 @@ def _clear_rt_state(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Drop all per-search/preview state (a completed download or a cancel)."""
     for k in ('rt_results', 'rt_forums', 'rt_selected', 'rt_buckets',
               'rt_smart', 'rt_preview', 'rt_dl_dir', 'rt_list_token',
-              'rt_category', 'magnet_link'):
+              'rt_category'):
         context.user_data.pop(k, None)
 
 
@@ -1562,18 +1849,19 @@ async def _handle_pick_dir(query, context: ContextTypes.DEFAULT_TYPE) -> None:
             "❌ Результаты поиска устарели. Попробуйте снова.")
         return
     dirs = transmission_client.get_download_dirs()
-    rows = [[InlineKeyboardButton(label, callback_data=f"rt_setdir:{path}")]
-            for label, path in dirs.items()]
-    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="rt_prev")])
+    markup = (_DEFAULT_PICK_DIR_KEYBOARD if dirs is DEFAULT_DOWNLOAD_DIRS
+              else _build_pick_dir_keyboard(dirs))
     await query.edit_message_text(
-        "📁 Выбери папку для скачивания:",
-        reply_markup=InlineKeyboardMarkup(rows))
+        "📁 Выбери папку для скачивания:", reply_markup=markup)
 
 
 async def _handle_set_dir(query, context: ContextTypes.DEFAULT_TYPE) -> None:
-    path = query.data[len("rt_setdir:"):]
+    path = query.data.partition(":")[2]
     dirs = transmission_client.get_download_dirs()
-    label = next((lbl for lbl, p in dirs.items() if p == path), path)
+    if dirs is DEFAULT_DOWNLOAD_DIRS:
+        label = _DIRS_LABELS.get(path, path)
+    else:
+        label = next((lbl for lbl, p in dirs.items() if p == path), path)
     context.user_data['rt_dl_dir'] = (label, path)
     await _render_preview(query, context)
 
@@ -1582,26 +1870,49 @@ async def _handle_cancel(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """🔄 Новый поиск: clear state and remove the results message so the
     user can start fresh (falls back to editing it if delete fails)."""
     _clear_rt_state(context)
+    _PENDING.pop(query.from_user.id, None)
     prompt = "🔍 Напиши новый запрос для поиска."
     chat_id = query.message.chat_id if query.message else query.from_user.id
     try:
         await query.message.delete()
     except Exception as exc:
-        logger.info(f"cancel: message delete failed: {exc}")
+        logger.info("cancel: message delete failed: %s", exc)
         await query.edit_message_text(prompt)
         return
     await query.get_bot().send_message(chat_id, prompt)
 
 
 async def _handle_download_selection(query, context: ContextTypes.DEFAULT_TYPE) -> None:
-    download_path = query.data.replace("download:", "")
-    magnet_link = context.user_data.get('magnet_link')
+    # "d:<index>", or "download:<path>" from keyboards sent before the
+    # switch to index tokens. Only the first ':' splits: paths may hold more.
+    prefix, _, value = query.data.partition(":")
+    if prefix == "d":
+        try:
+            idx = int(value)
+        except ValueError:
+            idx = -1
+        if not 0 <= idx < len(_DIRS_ITEMS):
+            await query.edit_message_text("❌ Invalid selection")
+            return
+        download_path = _DIRS_ITEMS[idx][1]
+    else:
+        download_path = value
+    magnet_links = _pop_pending_magnets(query.from_user.id)
 
-    if not magnet_link:
+    if not magnet_links:
         await query.edit_message_text("❌ No magnet link found. Please send a new one.")
         return
 
-    await _add_torrent_and_notify(query, context, magnet_link, download_path)
+    if len(magnet_links) == 1:
+        await _add_torrent_and_notify(query, context, magnet_links[0], download_path)
+    else:
+        await _add_torrents_and_notify(query, context, magnet_links, download_path)
+
+
+# Recently seen update_ids. Telegram re-delivers an update when the 200 OK is
+# late; a redelivered magnet callback must not add the torrent twice.
+_SEEN_UPDATES: OrderedDict = OrderedDict()
+_SEEN_UPDATES_MAX = 4096
 
 
 async def telegram_webhook_handler(request):
@@ -1610,15 +1921,20 @@ async def telegram_webhook_handler(request):
         # Verify secret token if configured
         if WEBHOOK_SECRET_TOKEN:
             secret_token_header = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
-            if secret_token_header != WEBHOOK_SECRET_TOKEN:
-                logger.warning(f"Invalid webhook secret token from {request.remote}")
+            # Constant-time compare: don't leak the token prefix via timing.
+            if not hmac.compare_digest((secret_token_header or '').encode(),
+                                       _WEBHOOK_SECRET_BYTES):
+                logger.warning("Invalid webhook secret token from %s", request.remote)
                 return web.Response(text='Unauthorized', status=401)
         
         # Get the application from the request
         application = request.app['telegram_application']
         
         # Parse the update from the request body
-        data = await request.json()
+        data = orjson.loads(await request.read())
+        update_id = data.get('update_id')
+        if update_id is not None and update_id in _SEEN_UPDATES:
+            return web.Response(text='OK', status=200)
         update = Update.de_json(data, application.bot)
         
         # Enqueue the update and ack Telegram immediately. Awaiting
@@ -1628,12 +1944,69 @@ async def telegram_webhook_handler(request):
         # old"). application.start() runs the queue consumer.
         await application.update_queue.put(update)
 
+        # Only mark it seen once it is queued: if parsing or the put fails we
+        # answer 500 and Telegram's redelivery must not count as a
+        # duplicate. No await between this check and the insert, so it is
+        # atomic on the event loop.
+        if update_id is not None and update_id not in _SEEN_UPDATES:
+            _SEEN_UPDATES[update_id] = None
+            if len(_SEEN_UPDATES) > _SEEN_UPDATES_MAX:
+                _SEEN_UPDATES.popitem(last=False)
+
         return web.Response(text='OK', status=200)
     except Exception as e:
-        logger.error(f"Error processing webhook: {e}")
+        logger.error("Error processing webhook: %s", e)
         return web.Response(text='Error', status=500)
 
 
+class QuietHealthzAccessLogger(web.AccessLogger):
+    """aiohttp access logger that skips the /healthz probe requests"""
+
+    def log(self, request, response, time):
+        if request.path != HEALTHZ_PATH:
+            super().log(request, response, time)
+
+
+def create_web_app(application: Application, webhook: bool) -> web.Application:
+    """Build the aiohttp app: /healthz and /status, plus /update in webhook mode"""
+    app = web.Application()
+    app['telegram_application'] = application
+    if webhook:
+        app.router.add_post('/update', telegram_webhook_handler)
+    app.router.add_get(HEALTHZ_PATH, healthz_handler)
+    app.router.add_get('/status', status_handler)
+    return app
+
+
+async def start_web_server(app: web.Application) -> web.AppRunner:
+    """Serve the aiohttp app on port 8080 inside the running event loop"""
+    runner = web.AppRunner(app, access_log_class=QuietHealthzAccessLogger)
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    await site.start()
+    logger.info("Web server started on port 8080")
+    return runner
+
+
+# Polling mode has no webhook server of its own; the health/status endpoints
+# run on PTB's event loop via post_init/post_shutdown.
+_polling_web_runner: web.AppRunner | None = None
+
+
+async def _start_polling_web_server(application: Application) -> None:
+    global _polling_web_runner
+    await transmission_client.ensure_connected()
+    _polling_web_runner = await start_web_server(
+        create_web_app(application, webhook=False))
+    logger.info("Available endpoints: /healthz, /status")
+
+
+async def _stop_polling_web_server(application: Application) -> None:
+    if _polling_web_runner:
+        await _polling_web_runner.cleanup()
+    await transmission_client.close()
+
+
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Global error handler. Without one, PTB logs every unhandled
     exception as 'No error handlers are registered' plus a raw traceback.
@@ -1641,13 +2014,15 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     BadRequest entirely."""
     err = context.error
     if isinstance(err, BadRequest) and "Query is too old" in str(err):
-        logger.info(f"ignored stale callback: {err}")
+        logger.info("ignored stale callback: %s", err)
         return
-    logger.error(f"unhandled exception in handler: {err!r}", exc_info=err)
+    logger.error("unhandled exception in handler: %r", err, exc_info=err)
 
 
 def main() -> None:
     """Start the bot."""
+    _setup_queue_logging()
+    
     if not TELEGRAM_BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN environment variable is required")
         return
@@ -1676,7 +2051,7 @@ def main() -> None:
     if WEBHOOK_MODE:
         # Webhook mode - run with custom web server
         logger.info("Starting Torrent Bot in webhook mode on port 8080")
-        logger.info(f"Webhook URL: {WEBHOOK_URL}")
+        logger.info("Webhook URL: %s", WEBHOOK_URL)
         
         # Warn if secret token is not set
         if not WEBHOOK_SECRET_TOKEN:
@@ -1687,55 +2062,53 @@ def main() -> None:
             # Initialize the application
             await application.initialize()
             await application.start()
+            await transmission_client.ensure_connected()
             
             # Set webhook
             await application.bot.set_webhook(
                 url=WEBHOOK_URL,
-                allowed_updates=["message", "callback_query"],
+                allowed_updates=ALLOWED_UPDATES,
                 secret_token=WEBHOOK_SECRET_TOKEN
             )
-            logger.info(f"Webhook set to {WEBHOOK_URL}")
-            
-            # Create aiohttp web application
-            app = web.Application()
-            app['telegram_application'] = application
-            
-            # Add routes
-            app.router.add_post('/update', telegram_webhook_handler)
-            app.router.add_get(HEALTHZ_PATH, healthz_handler)
-            app.router.add_get('/status', status_handler)
-            
-            # Start the web server with custom access logger
-            class CustomAccessLogger(web.AccessLogger):
-                def log(self, request, response, time):
-                    # Skip logging for /healthz endpoint
-                    if request.path != HEALTHZ_PATH:
-                        super().log(request, response, time)
-            
-            runner = web.AppRunner(app, access_log_class=CustomAccessLogger)
-            await runner.setup()
-            site = web.TCPSite(runner, '0.0.0.0', 8080)
-            await site.start()
+            logger.info("Webhook set to %s", WEBHOOK_URL)
             
-            logger.info("Web server started on port 8080")
+            # Start the aiohttp web server
+            runner = await start_web_server(
+                create_web_app(application, webhook=True))
             logger.info("Available endpoints: /update, /healthz, /status")
             
-            # Keep running
+            # Keep running until SIGTERM (container stop) or SIGINT. Without
+            # handlers asyncio.run just cancels this task, skipping cleanup.
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop_event.set)
             try:
-                await asyncio.Event().wait()
-            except (KeyboardInterrupt, SystemExit):
+                await stop_event.wait()
                 logger.info("Stopping...")
             finally:
+                # The webhook is deliberately left registered: on a rolling
+                # deploy the new pod has already set it by the time the old
+                # one gets SIGTERM, and Telegram holds updates meanwhile.
                 await runner.cleanup()
                 await application.stop()
                 await application.shutdown()
+                # Last: stop() still drains queued updates and waits for
+                # running handlers, which may call Transmission.
+                await transmission_client.close()
         
         # Run the webhook server
         asyncio.run(run_webhook())
     else:
         # Polling mode (default)
         logger.info("Starting Torrent Bot in polling mode...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        application.post_init = _start_polling_web_server
+        application.post_shutdown = _stop_polling_web_server
+        # Long-poll close to Telegram's limit: a quiet bot then makes one
+        # getUpdates request per ~50s instead of one every 10s, and updates
+        # still arrive the moment they are sent.
+        application.run_polling(allowed_updates=ALLOWED_UPDATES,
+                                timeout=POLLING_TIMEOUT, poll_interval=0.0)
 
 
 if __name__ == '__main__':